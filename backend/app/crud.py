@@ -1,9 +1,24 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-import datetime
+from sqlalchemy import update, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.attributes import set_committed_value
 import uuid
 
+from uuid6 import uuid7
+
 from . import models, schemas
+from .qr import render_qr_png
+
+# Единственная строка общей статистики в таблице qr_stats
+GLOBAL_STATS_ID = 1
+
+
+def _insert(db: AsyncSession, model):
+    """INSERT с поддержкой ON CONFLICT для диалекта текущей БД (Postgres или SQLite)."""
+    dialect = postgresql if db.bind.dialect.name == "postgresql" else sqlite
+    return dialect.insert(model)
 
 
 async def get_qr_code(db: AsyncSession, qr_code_id: uuid.UUID):
@@ -12,12 +27,55 @@ async def get_qr_code(db: AsyncSession, qr_code_id: uuid.UUID):
     return result.scalars().first()
 
 
+async def get_qr_code_status(db: AsyncSession, qr_code_id: uuid.UUID):
+    """
+    Получает только статус и данные владельца QR-кода — без загрузки ORM-объекта целиком.
+    Возвращает None, если кода нет.
+    """
+    stmt = select(
+        models.QRCode.status,
+        models.QRCode.telegram_id,
+        models.QRCode.user_first_name,
+        models.QRCode.user_username,
+    ).filter(models.QRCode.id == qr_code_id)
+    result = await db.execute(stmt)
+    return result.first()
+
+
+async def get_qr_code_png(db: AsyncSession, qr_code_id: uuid.UUID):
+    """Получает только PNG-изображение QR-кода. Возвращает None, если кода нет."""
+    result = await db.execute(select(models.QRCode.png).filter(models.QRCode.id == qr_code_id))
+    return result.first()
+
+
 async def get_qr_codes(db: AsyncSession, skip: int = 0, limit: int = 100):
     """Получает список QR-кодов из БД с пагинацией."""
     result = await db.execute(select(models.QRCode).offset(skip).limit(limit))
     return result.scalars().all()
 
 
+async def stream_qr_codes(db: AsyncSession, skip: int = 0, limit: int = 100):
+    """Потоково отдает строки QR-кодов (только поля схемы QRCode, без картинки)."""
+    stmt = (
+        select(
+            models.QRCode.id,
+            models.QRCode.status,
+            models.QRCode.telegram_id,
+            models.QRCode.user_first_name,
+            models.QRCode.user_username,
+            models.QRCode.created_at,
+            models.QRCode.issued_at,
+            models.QRCode.used_at,
+            models.QRCode.telegram_file_id,
+        )
+        .offset(skip)
+        .limit(limit)
+    )
+    result = await db.stream(stmt)
+    async for row in result:
+        yield row
+
+
 async def get_qr_code_by_telegram_id(db: AsyncSession, telegram_id: str):
     """Находит QR-код в БД по Telegram ID пользователя."""
     result = await db.execute(select(models.QRCode).filter(models.QRCode.telegram_id == telegram_id))
@@ -27,40 +85,162 @@ async def get_qr_code_by_telegram_id(db: AsyncSession, telegram_id: str):
 async def create_qr_code(db: AsyncSession, qr_code: schemas.QRCodeCreate):
     """
     Создает новый QR-код или возвращает существующий для данного Telegram ID.
-    Гарантирует, что у одного пользователя будет только один QR-код.
+    Гарантирует, что у одного пользователя будет только один QR-код:
+    один INSERT ... ON CONFLICT (telegram_id) без отдельного SELECT и без гонки между ними.
     """
-    existing_qr_code = await get_qr_code_by_telegram_id(db, telegram_id=qr_code.telegram_id)
-    if existing_qr_code:
-        return existing_qr_code
-
-    # 2. Если нет, создаем новый
-    db_qr_code = models.QRCode(
+    qr_code_id = uuid7()
+    stmt = _insert(db, models.QRCode).values(
+        id=qr_code_id,
         telegram_id=qr_code.telegram_id,
         user_first_name=qr_code.user_first_name,
         user_username=qr_code.user_username,
         status=models.QRCodeStatus.ISSUED, # Сразу помечаем как "выдан"
-        issued_at=datetime.datetime.utcnow()
+        issued_at=func.now()
     )
-    db.add(db_qr_code)
+    # Пустое обновление нужно, чтобы RETURNING вернул уже существующую строку
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.QRCode.telegram_id],
+        set_={"telegram_id": stmt.excluded.telegram_id},
+    ).returning(models.QRCode).options(undefer(models.QRCode.png))
+    result = await db.execute(stmt, execution_options={"populate_existing": True})
+    db_qr_code = result.scalar_one()
+
+    # Картинку рисуем только для только что созданного кода: payload (UUID) больше не меняется
+    if db_qr_code.id == qr_code_id:
+        png = render_qr_png(qr_code_id)
+        await db.execute(
+            update(models.QRCode)
+            .where(models.QRCode.id == qr_code_id)
+            .values(png=png)
+            .execution_options(synchronize_session=False)
+        )
+        # Картинка уже на руках — кладем ее в объект как загруженную, чтобы не перечитывать из БД
+        set_committed_value(db_qr_code, "png", png)
     await db.commit()
-    await db.refresh(db_qr_code)
     return db_qr_code
 
 
 async def update_qr_code_status(db: AsyncSession, qr_code_id: uuid.UUID, status: models.QRCodeStatus):
-    """Обновляет статус существующего QR-кода (например, на 'used')."""
-    db_qr_code = await get_qr_code(db, qr_code_id)
-    if not db_qr_code:
-        return None
-    
-    db_qr_code.status = status
-    
-    if status == models.QRCodeStatus.ISSUED:
-        db_qr_code.issued_at = datetime.datetime.utcnow()
-    elif status == models.QRCodeStatus.USED:
-        db_qr_code.used_at = datetime.datetime.utcnow()
+    """Обновляет статус существующего QR-кода (например, на 'used') одним запросом UPDATE ... RETURNING."""
+    timestamp_fields = {
+        models.QRCodeStatus.ISSUED: {"issued_at": func.now()},
+        models.QRCodeStatus.USED: {"used_at": func.now()},
+    }.get(status, {})
+
+    stmt = (
+        update(models.QRCode)
+        .where(models.QRCode.id == qr_code_id)
+        .values(status=status, **timestamp_fields)
+        .returning(models.QRCode)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    db_qr_code = result.scalar_one_or_none()
+    await db.commit()
+    return db_qr_code
 
+
+async def set_qr_code_telegram_file_id(db: AsyncSession, qr_code_id: uuid.UUID, telegram_file_id: str):
+    """Сохраняет file_id фото QR-кода в Telegram. Возвращает None, если кода нет."""
+    stmt = (
+        update(models.QRCode)
+        .where(models.QRCode.id == qr_code_id)
+        .values(telegram_file_id=telegram_file_id)
+        .returning(models.QRCode)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    db_qr_code = result.scalar_one_or_none()
     await db.commit()
-    await db.refresh(db_qr_code)
     return db_qr_code
 
+
+async def mark_qr_code_used(db: AsyncSession, qr_code_id: uuid.UUID):
+    """
+    Атомарно переводит QR-код из статуса 'issued' в 'used'.
+    Возвращает данные владельца кода или None, если код не найден или уже не в статусе 'issued'.
+    Транзакцию не фиксирует: коммит делает check_qr_code вместе со статистикой.
+    """
+    stmt = (
+        update(models.QRCode)
+        .where(models.QRCode.id == qr_code_id, models.QRCode.status == models.QRCodeStatus.ISSUED)
+        .values(status=models.QRCodeStatus.USED, used_at=func.now())
+        .returning(
+            models.QRCode.telegram_id,
+            models.QRCode.user_first_name,
+            models.QRCode.user_username,
+            models.QRCode.status,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    return result.first()
+
+
+async def init_global_stats(db: AsyncSession):
+    """Создает строку общей статистики, если ее еще нет."""
+    stmt = _insert(db, models.QRStats).values(id=GLOBAL_STATS_ID, success_count=0, fail_count=0)
+    await db.execute(stmt.on_conflict_do_nothing(index_elements=[models.QRStats.id]))
+    await db.commit()
+
+
+async def record_scan(db: AsyncSession, admin_telegram_id: str | None, success: bool):
+    """
+    Атомарно увеличивает общую статистику и статистику админа.
+    Возвращает актуальные значения счётчиков. Транзакцию не фиксирует.
+    """
+    success_inc, fail_inc = (1, 0) if success else (0, 1)
+
+    result = await db.execute(
+        update(models.QRStats)
+        .where(models.QRStats.id == GLOBAL_STATS_ID)
+        .values(
+            success_count=models.QRStats.success_count + success_inc,
+            fail_count=models.QRStats.fail_count + fail_inc,
+        )
+        .returning(models.QRStats.success_count, models.QRStats.fail_count)
+    )
+    global_row = result.first()
+    stats = {
+        "success": global_row.success_count if global_row else 0,
+        "fail": global_row.fail_count if global_row else 0,
+        "admin_success": 0,
+        "admin_fail": 0,
+    }
+
+    if admin_telegram_id:
+        stmt = _insert(db, models.AdminStats).values(
+            admin_telegram_id=admin_telegram_id, success_count=success_inc, fail_count=fail_inc
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[models.AdminStats.admin_telegram_id],
+            set_={
+                "success_count": models.AdminStats.success_count + success_inc,
+                "fail_count": models.AdminStats.fail_count + fail_inc,
+            },
+        ).returning(models.AdminStats.success_count, models.AdminStats.fail_count)
+        admin_row = (await db.execute(stmt)).one()
+        stats["admin_success"] = admin_row.success_count
+        stats["admin_fail"] = admin_row.fail_count
+
+    return stats
+
+
+async def check_qr_code(db: AsyncSession, qr_code_id: uuid.UUID | None, admin_telegram_id: str | None):
+    """
+    Проверка QR-кода на входе целиком, в одной транзакции с одним коммитом:
+    условный перевод ISSUED -> USED, при неудаче дочитывание статуса и обновление счётчиков.
+    Возвращает (данные кода или None, прошел ли скан, счётчики статистики).
+    """
+    db_qr_code = None
+    # ISSUED -> USED одним условным UPDATE: из двух одновременных сканов пройдёт только один
+    if qr_code_id is not None:
+        db_qr_code = await mark_qr_code_used(db, qr_code_id=qr_code_id)
+    just_used = db_qr_code is not None
+    if not just_used and qr_code_id is not None:
+        # Код не найден или уже не в статусе ISSUED — дочитываем статус, чтобы понять причину
+        db_qr_code = await get_qr_code_status(db, qr_code_id=qr_code_id)
+
+    stats = await record_scan(db, admin_telegram_id=admin_telegram_id, success=just_used)
+    await db.commit()
+    return db_qr_code, just_used, stats
@@ -1,19 +1,31 @@
-from fastapi import FastAPI, Depends, HTTPException, Response, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, Depends, HTTPException, Response, Request, BackgroundTasks, Body
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from sqlalchemy.ext.asyncio import AsyncSession
-import qrcode
-from io import BytesIO
+import base64
 import uuid
 import httpx
+import orjson
 import os
-from sqlalchemy import select, update
+from sqlalchemy import select, inspect, text
+from sqlalchemy.exc import DBAPIError
 from fastapi.staticfiles import StaticFiles
 
 from . import crud, models, schemas
-from .database import engine, get_db, Base
+from .qr import RENDER_VERSION, decode_qr_payload, render_qr_png
+from .database import engine, get_db, Base, SessionLocal
 from .models import QRStats
 
+
+class ORJSONResponse(JSONResponse):
+    """JSON-ответ, сериализуемый через orjson вместо стандартного json."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
 app = FastAPI(title="QR Code Service")
+app.add_middleware(GZipMiddleware, minimum_size=500)
 
 # Раздача статических файлов из папки frontend
 frontend_path = os.path.join(os.path.dirname(__file__), '../../frontend')
@@ -21,43 +33,108 @@ app.mount("/frontend", StaticFiles(directory=frontend_path), name="frontend")
 
 # Создаем таблицы в БД при старте
 # В реальном проекте лучше использовать миграции (Alembic)
+def _upgrade_existing_tables(sync_conn):
+    """
+    Добавляет в уже существующие таблицы новые nullable-колонки и индексы:
+    create_all создает только отсутствующие таблицы.
+    """
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=sync_conn.dialect)
+                sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+# Ошибки, которые означают, что таблицу, колонку или индекс успел создать другой процесс
+_SCHEMA_RACE_MARKERS = ("already exists", "duplicate column", "duplicate key")
+
+
+async def init_schema(attempts: int = 5):
+    """
+    Создает недостающие таблицы, колонки и индексы.
+    Между проверкой и CREATE/ALTER схему может изменить другой воркер — тогда транзакция
+    откатывается и проверка повторяется уже по обновленной схеме.
+    """
+    for attempt in range(attempts):
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.run_sync(_upgrade_existing_tables)
+            return
+        except DBAPIError as exc:
+            message = str(exc.orig).lower()
+            if attempt == attempts - 1 or not any(marker in message for marker in _SCHEMA_RACE_MARKERS):
+                raise
+
+
+async def init_database():
+    """Создает таблицы в базе данных, если их нет. И инициализирует статистику."""
+    await init_schema()
+    # Инициализация статистики (безопасно при одновременном старте нескольких воркеров)
+    async with AsyncSession(engine) as session:
+        await crud.init_global_stats(session)
+
+
 @app.on_event("startup")
 async def startup():
-    """Создает таблицы в базе данных при запуске приложения, если их нет. И инициализирует статистику."""
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    # Инициализация статистики
-    async with AsyncSession(engine) as session:
-        result = await session.execute(select(QRStats))
-        stats = result.scalars().first()
-        if not stats:
-            stats = QRStats(success_count=0, fail_count=0)
-            session.add(stats)
-            await session.commit()
+    """
+    Готовит базу при запуске приложения. run_server.py делает это один раз до старта воркеров,
+    здесь повтор нужен для запуска через uvicorn напрямую.
+    """
+    await init_database()
 
 
-@app.get("/", summary="Проверка работы сервиса")
+@app.get("/", response_class=ORJSONResponse, summary="Проверка работы сервиса")
 async def root():
     """Корневой эндпоинт для проверки, что сервис запущен и работает."""
     return {"message": "QR Code Service is running"}
 
 
-@app.post("/qrcodes/", response_model=schemas.QRCode, summary="Создать или получить QR-код")
+@app.post("/qrcodes/", response_model=schemas.QRCodeWithImage, summary="Создать или получить QR-код")
 async def create_qr_code_endpoint(
-    qr_code: schemas.QRCodeCreate, db: AsyncSession = Depends(get_db)
+    qr_code: schemas.QRCodeCreate,
+    return_image: bool = False,
+    force_image: bool = False,
+    db: AsyncSession = Depends(get_db),
 ):
     """
     Создает QR-код для пользователя по его Telegram ID.
     Если у пользователя уже есть код, возвращает существующий.
+    С return_image=true в ответ добавляется PNG в base64 — отдельный запрос за картинкой не нужен.
+    Если у кода уже есть telegram_file_id, картинка не добавляется: ее можно отправить по file_id.
+    force_image=true добавляет картинку и в этом случае — например, когда file_id выдан другим ботом
+    и Telegram его больше не принимает.
     """
-    return await crud.create_qr_code(db=db, qr_code=qr_code)
+    db_qr_code = await crud.create_qr_code(db=db, qr_code=qr_code)
+    response = schemas.QRCodeWithImage.model_validate(db_qr_code)
+    if return_image and (force_image or not db_qr_code.telegram_file_id):
+        png = db_qr_code.png if db_qr_code.png is not None else render_qr_png(db_qr_code.id)
+        response.image_b64 = base64.b64encode(png).decode("ascii")
+    return response
 
 
 @app.get("/qrcodes/", response_model=list[schemas.QRCode])
-async def read_qr_codes(
-    skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)
-):
-    return await crud.get_qr_codes(db, skip=skip, limit=limit)
+async def read_qr_codes(skip: int = 0, limit: int = 100):
+    """Отдает список QR-кодов потоком: строки сериализуются orjson по мере чтения из БД."""
+    async def rows_as_json():
+        # Своя сессия: зависимость get_db закрывается раньше, чем ответ будет отдан целиком
+        async with SessionLocal() as db:
+            yield b"["
+            first = True
+            async for row in crud.stream_qr_codes(db, skip=skip, limit=limit):
+                if not first:
+                    yield b","
+                first = False
+                yield orjson.dumps(dict(row._mapping))
+            yield b"]"
+
+    return StreamingResponse(rows_as_json(), media_type="application/json")
 
 
 @app.get("/qrcodes/{qr_code_id}", response_model=schemas.QRCode)
@@ -67,19 +144,28 @@ async def read_qr_code(qr_code_id: uuid.UUID, db: AsyncSession = Depends(get_db)
         raise HTTPException(status_code=404, detail="QR code not found")
     return db_qr_code
 
+# Картинка меняется только при смене RENDER_VERSION: сутки отдаем из кэша,
+# дальше клиент перепроверяет ETag и обычно получает 304 без тела
+IMAGE_CACHE_HEADERS = {"Cache-Control": "public, max-age=86400"}
+
+
 @app.get("/qrcodes/{qr_code_id}/image", summary="Получить изображение QR-кода")
-async def get_qr_code_image(qr_code_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
-    """Генерирует и возвращает PNG-изображение QR-кода по его UUID."""
-    db_qr_code = await crud.get_qr_code(db, qr_code_id=qr_code_id)
-    if db_qr_code is None:
+async def get_qr_code_image(qr_code_id: uuid.UUID, request: Request, db: AsyncSession = Depends(get_db)):
+    """Возвращает PNG-изображение QR-кода по его UUID. Картинка рисуется один раз при выдаче кода."""
+    etag = f'"{qr_code_id}-v{RENDER_VERSION}"'
+    if request.headers.get("if-none-match") == etag:
+        # Существование кода проверяем и для 304, но без чтения самой картинки
+        if await crud.get_qr_code_status(db, qr_code_id=qr_code_id) is None:
+            raise HTTPException(status_code=404, detail="QR code not found")
+        return Response(status_code=304, headers={"ETag": etag, **IMAGE_CACHE_HEADERS})
+
+    row = await crud.get_qr_code_png(db, qr_code_id=qr_code_id)
+    if row is None:
         raise HTTPException(status_code=404, detail="QR code not found")
 
-    img = qrcode.make(str(qr_code_id))
-    buf = BytesIO()
-    img.save(buf)
-    buf.seek(0)
-    
-    return Response(content=buf.getvalue(), media_type="image/png")
+    # Коды, выданные до появления колонки png, дорисовываем на лету
+    png = row.png if row.png is not None else render_qr_png(qr_code_id)
+    return Response(content=png, media_type="image/png", headers={"ETag": etag, **IMAGE_CACHE_HEADERS})
 
 @app.put("/qrcodes/{qr_code_id}/status", response_model=schemas.QRCode)
 async def update_qr_code_status(
@@ -90,6 +176,18 @@ async def update_qr_code_status(
         raise HTTPException(status_code=404, detail="QR code not found")
     return db_qr_code
 
+@app.put("/qrcodes/{qr_code_id}/telegram_file_id", response_model=schemas.QRCode)
+async def update_qr_code_telegram_file_id(
+    qr_code_id: uuid.UUID, body: schemas.QRCodeTelegramFileId, db: AsyncSession = Depends(get_db)
+):
+    """Сохраняет file_id фото QR-кода в Telegram, чтобы бот переиспользовал его и после перезапуска."""
+    db_qr_code = await crud.set_qr_code_telegram_file_id(
+        db, qr_code_id=qr_code_id, telegram_file_id=body.telegram_file_id
+    )
+    if db_qr_code is None:
+        raise HTTPException(status_code=404, detail="QR code not found")
+    return db_qr_code
+
 @app.get("/scanner", response_class=FileResponse, summary="Получить страницу сканера")
 async def get_scanner_page():
     file_path = os.path.join(os.path.dirname(__file__), "frontend", "scanner.html")
@@ -97,43 +195,20 @@ async def get_scanner_page():
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
-# Глобальная статистика по сканированиям для каждого админа
-admin_stats = {}
-# Глобальная статистика по всем сканированиям
-global_success = 0
-global_fail = 0
-
-import asyncio
-from sqlalchemy import update
-
-# Фоновая задача для сохранения статистики в базу каждые 10 минут
-async def stats_saver():
-    from .models import QRStats
-    global global_success, global_fail, admin_stats
-    while True:
-        await asyncio.sleep(600)  # 10 минут
-        async with AsyncSession(engine) as session:
-            # Общая статистика
-            result = await session.execute(select(QRStats))
-            stats = result.scalars().first()
-            if not stats:
-                stats = QRStats(success_count=0, fail_count=0)
-                session.add(stats)
-                await session.commit()
-                await session.refresh(stats)
-            stats.success_count += global_success
-            stats.fail_count += global_fail
-            await session.commit()
-        # Можно добавить сохранение статистики по админам в отдельную таблицу, если нужно
-        global_success = 0
-        global_fail = 0
-        for admin_id in admin_stats:
-            admin_stats[admin_id]["success"] = 0
-            admin_stats[admin_id]["fail"] = 0
-
 @app.on_event("startup")
-async def start_stats_saver():
-    asyncio.create_task(stats_saver())
+async def start_http_client():
+    """Создает общий HTTP-клиент: соединения и TLS-сессия с api.telegram.org переиспользуются."""
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    )
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
 
 async def send_telegram_message(chat_id: str, text: str):
     """Отправляет сообщение пользователю через Telegram Bot API."""
@@ -141,67 +216,74 @@ async def send_telegram_message(chat_id: str, text: str):
         return
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {"chat_id": chat_id, "text": text}
-    async with httpx.AsyncClient() as client:
-        try:
-            await client.post(url, json=payload, timeout=10)
-        except Exception:
-            pass
+    try:
+        await app.state.http.post(url, json=payload)
+    except Exception:
+        pass
 
-@app.post("/check_qr/{qr_code_id}", summary="Проверить QR-код")
-async def check_qr_code(qr_code_id: uuid.UUID, request: Request, db: AsyncSession = Depends(get_db)):
-    db_qr_code = await crud.get_qr_code(db, qr_code_id=qr_code_id)
-    data = await request.json() if request.headers.get('content-type', '').startswith('application/json') else {}
-    admin_telegram_id = str(data.get('admin_telegram_id')) if data.get('admin_telegram_id') else None
+# Сообщение админу после скана: одна заготовка на все исходы, заполняется счётчиками из record_scan
+_ADMIN_TMPL = (
+    "{prefix}\n\n"
+    "Ваша статистика:\n  ✅ Успешно: {admin_success}\n  ⛔ Отклонено: {admin_fail}\n\n"
+    "Общая статистика:\n  ✅ Всего успешно: {success}\n  ⛔ Всего отклонено: {fail}"
+)
 
-    if admin_telegram_id:
-        if admin_telegram_id not in admin_stats:
-            admin_stats[admin_telegram_id] = {"success": 0, "fail": 0}
 
-    global global_success, global_fail
+@app.post("/check_qr/{qr_code_id}", response_class=ORJSONResponse, summary="Проверить QR-код")
+async def check_qr_code(
+    qr_code_id: str,
+    background_tasks: BackgroundTasks,
+    payload: schemas.CheckPayload | None = Body(default=None),
+    db: AsyncSession = Depends(get_db),
+):
+    # В пути приходит содержимое QR-кода: base32-форма UUID или канонический UUID
+    parsed_id = decode_qr_payload(qr_code_id)
+    admin_telegram_id = payload.admin_telegram_id if payload and payload.admin_telegram_id else None
+
+    # Статус кода и счётчики обновляются в одной транзакции
+    db_qr_code, just_used, stats = await crud.check_qr_code(
+        db, qr_code_id=parsed_id, admin_telegram_id=admin_telegram_id
+    )
 
+    # Уведомления в Telegram уходят фоном после ответа сканеру и не задерживают его
     if not db_qr_code:
         if admin_telegram_id:
-            admin_stats[admin_telegram_id]["fail"] += 1
-        global_fail += 1
-        await send_telegram_message(
-            admin_telegram_id,
-            f"❌ Код не найден.\n\nВаша статистика:\n  ✅ Успешно: {admin_stats[admin_telegram_id]['success']}\n  ⛔ Отклонено: {admin_stats[admin_telegram_id]['fail']}\n\nОбщая статистика:\n  ✅ Всего успешно: {global_success}\n  ⛔ Всего отклонено: {global_fail}"
-        )
-        return JSONResponse(status_code=404, content={"status": "error", "message": "❌ Код не найден"})
-    if db_qr_code.status == models.QRCodeStatus.USED:
-        await send_telegram_message(db_qr_code.telegram_id, "⛔ Этот QR-код уже был использован ранее. Вход запрещён.")
-        if admin_telegram_id:
-            admin_stats[admin_telegram_id]["fail"] += 1
-        global_fail += 1
-        await send_telegram_message(
-            admin_telegram_id,
-            f"⛔ Этот QR-код уже был использован ранее. Вход запрещён.\n\nВаша статистика:\n  ✅ Успешно: {admin_stats[admin_telegram_id]['success']}\n  ⛔ Отклонено: {admin_stats[admin_telegram_id]['fail']}\n\nОбщая статистика:\n  ✅ Всего успешно: {global_success}\n  ⛔ Всего отклонено: {global_fail}"
-        )
-        return JSONResponse(status_code=400, content={"status": "error", "message": f"⚠️ Код уже был использован"})
-    if db_qr_code.status == models.QRCodeStatus.ISSUED:
-        await crud.update_qr_code_status(db, qr_code_id=qr_code_id, status=models.QRCodeStatus.USED)
+            background_tasks.add_task(
+                send_telegram_message,
+                admin_telegram_id,
+                _ADMIN_TMPL.format_map({**stats, "prefix": "❌ Код не найден."})
+            )
+        return ORJSONResponse(status_code=404, content={"status": "error", "message": "❌ Код не найден"})
+    if just_used:
         user_info = db_qr_code.user_first_name or ""
         if db_qr_code.user_username:
             user_info += f" (@{db_qr_code.user_username})"
-        await send_telegram_message(db_qr_code.telegram_id, "✅ Ваш QR-код успешно отсканирован! Добро пожаловать на мероприятие.")
+        background_tasks.add_task(send_telegram_message, db_qr_code.telegram_id, "✅ Ваш QR-код успешно отсканирован! Добро пожаловать на мероприятие.")
+        if admin_telegram_id:
+            background_tasks.add_task(
+                send_telegram_message,
+                admin_telegram_id,
+                _ADMIN_TMPL.format_map({**stats, "prefix": f"✅ QR-код успешно отсканирован: {user_info}"})
+            )
+        return ORJSONResponse(status_code=200, content={"status": "ok", "message": f"✅ Успех! {user_info}"})
+    if db_qr_code.status == models.QRCodeStatus.USED:
+        background_tasks.add_task(send_telegram_message, db_qr_code.telegram_id, "⛔ Этот QR-код уже был использован ранее. Вход запрещён.")
         if admin_telegram_id:
-            admin_stats[admin_telegram_id]["success"] += 1
-        global_success += 1
-        await send_telegram_message(
+            background_tasks.add_task(
+                send_telegram_message,
+                admin_telegram_id,
+                _ADMIN_TMPL.format_map({**stats, "prefix": "⛔ Этот QR-код уже был использован ранее. Вход запрещён."})
+            )
+        return ORJSONResponse(status_code=400, content={"status": "error", "message": f"⚠️ Код уже был использован"})
+    if admin_telegram_id:
+        background_tasks.add_task(
+            send_telegram_message,
             admin_telegram_id,
-            f"✅ QR-код успешно отсканирован: {user_info}\n\nВаша статистика:\n  ✅ Успешно: {admin_stats[admin_telegram_id]['success']}\n  ⛔ Отклонено: {admin_stats[admin_telegram_id]['fail']}\n\nОбщая статистика:\n  ✅ Всего успешно: {global_success}\n  ⛔ Всего отклонено: {global_fail}"
+            _ADMIN_TMPL.format_map({**stats, "prefix": f"❓ Неверный статус кода: {db_qr_code.status.value}"})
         )
-        return JSONResponse(status_code=200, content={"status": "ok", "message": f"✅ Успех! {user_info}"})
-    if admin_telegram_id:
-        admin_stats[admin_telegram_id]["fail"] += 1
-    global_fail += 1
-    await send_telegram_message(
-        admin_telegram_id,
-        f"❓ Неверный статус кода: {db_qr_code.status.value}\n\nВаша статистика:\n  ✅ Успешно: {admin_stats[admin_telegram_id]['success']}\n  ⛔ Отклонено: {admin_stats[admin_telegram_id]['fail']}\n\nОбщая статистика:\n  ✅ Всего успешно: {global_success}\n  ⛔ Всего отклонено: {global_fail}"
-    )
-    return JSONResponse(status_code=400, content={"status": "error", "message": f"❓ Неверный статус кода: {db_qr_code.status.value}"})
+    return ORJSONResponse(status_code=400, content={"status": "error", "message": f"❓ Неверный статус кода: {db_qr_code.status.value}"})
 
-@app.get("/stats", summary="Получить общую статистику")
+@app.get("/stats", response_class=ORJSONResponse, summary="Получить общую статистику")
 async def get_stats(db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(QRStats))
     stats = result.scalars().first()
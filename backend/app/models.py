@@ -1,9 +1,9 @@
-import uuid
 import enum
-from sqlalchemy import Column, String, DateTime, func, Enum as SQLEnum, Integer
+from sqlalchemy import Column, String, DateTime, func, Enum as SQLEnum, Integer, Index, LargeBinary, text
+from sqlalchemy.orm import deferred
 from sqlalchemy.dialects.postgresql import UUID
+from uuid6 import uuid7
 from .database import Base
-import datetime
 
 class QRCodeStatus(str, enum.Enum):
     CREATED = "created"
@@ -14,17 +14,41 @@ class QRCodeStatus(str, enum.Enum):
 class QRCode(Base):
     __tablename__ = "qrcodes"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    # UUIDv7 упорядочен по времени: новые коды ложатся в конец индекса, а не в случайные страницы
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
     status = Column(SQLEnum(QRCodeStatus), nullable=False, default=QRCodeStatus.CREATED)
     telegram_id = Column(String, nullable=True, index=True, unique=True)
     user_first_name = Column(String, nullable=True)
     user_username = Column(String, nullable=True)
-    created_at = Column(DateTime, server_default=func.now())
-    issued_at = Column(DateTime, nullable=True)
-    used_at = Column(DateTime, nullable=True)
+    # Время проставляет сама БД (now()), поэтому все метки — с часовым поясом
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    issued_at = Column(DateTime(timezone=True), nullable=True)
+    used_at = Column(DateTime(timezone=True), nullable=True)
+    # PNG рисуется один раз при выдаче; deferred — чтобы не тянуть байты в обычных запросах
+    png = deferred(Column(LargeBinary, nullable=True))
+    # file_id фото в Telegram после первой отправки: дальше бот шлет картинку по нему, без загрузки байтов
+    telegram_file_id = Column(String, nullable=True)
+
+    # Частичный индекс только по еще не погашенным кодам: условный UPDATE в /check_qr
+    # (WHERE id = ... AND status = 'issued') работает с маленьким индексом
+    __table_args__ = (
+        Index(
+            "ix_qrcodes_id_status",
+            "id",
+            "status",
+            postgresql_where=text("status = 'ISSUED'"),
+            sqlite_where=text("status = 'ISSUED'"),
+        ),
+    )
 
 class QRStats(Base):
     __tablename__ = "qr_stats"
     id = Column(Integer, primary_key=True, index=True)
     success_count = Column(Integer, default=0)
     fail_count = Column(Integer, default=0)
+
+class AdminStats(Base):
+    __tablename__ = "admin_stats"
+    admin_telegram_id = Column(String, primary_key=True)
+    success_count = Column(Integer, nullable=False, default=0)
+    fail_count = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,52 @@
+import base64
+import binascii
+import uuid
+from functools import lru_cache
+from io import BytesIO
+
+import segno
+
+# Содержимое QR-кода — 16 байт UUID в base32 без паддинга (26 символов вместо 36).
+# Алфавит base32 (A-Z, 2-7) попадает в алфавитно-цифровой режим QR, поэтому матрица
+# получается меньшей версии, чем для канонической строки UUID.
+
+# Версия картинки для ETag: увеличивайте при любом изменении payload или параметров отрисовки,
+# иначе клиенты, закэшировавшие старый PNG, так и будут получать 304 на старые байты.
+# 1 — канонический UUID и qrcode, 2 — base32 и segno (scale=10, border=4).
+RENDER_VERSION = 2
+
+
+def encode_qr_payload(qr_code_id: uuid.UUID) -> str:
+    """Кодирует UUID в строку, которая зашивается в QR-код."""
+    return base64.b32encode(qr_code_id.bytes).decode("ascii").rstrip("=")
+
+
+def decode_qr_payload(payload: str) -> uuid.UUID | None:
+    """
+    Разбирает отсканированное содержимое QR-кода.
+    Принимает как base32-форму, так и канонический UUID (коды, выданные раньше).
+    Возвращает None, если строка не похожа ни на то, ни на другое.
+    """
+    try:
+        return uuid.UUID(payload)
+    except ValueError:
+        pass
+    try:
+        raw = base64.b32decode(payload.upper() + "=" * (-len(payload) % 8))
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) != 16:
+        return None
+    return uuid.UUID(bytes=raw)
+
+
+@lru_cache(maxsize=4096)
+def _render_png(payload: str) -> bytes:
+    buf = BytesIO()
+    segno.make(payload, error="L").save(buf, kind="png", scale=10, border=4)
+    return buf.getvalue()
+
+
+def render_qr_png(qr_code_id: uuid.UUID) -> bytes:
+    """Рисует PNG с QR-кодом для данного UUID."""
+    return _render_png(encode_qr_payload(qr_code_id))
@@ -16,10 +16,16 @@ class QRCode(BaseModel):
     created_at: datetime.datetime
     issued_at: Optional[datetime.datetime] = None
     used_at: Optional[datetime.datetime] = None
+    telegram_file_id: Optional[str] = None
 
     model_config = ConfigDict(from_attributes=True)
 
 
+# QR-код вместе с PNG-изображением в base64 (ответ POST /qrcodes/?return_image=true)
+class QRCodeWithImage(QRCode):
+    image_b64: Optional[str] = None
+
+
 # Схема для создания нового QR-кода
 class QRCodeCreate(BaseModel):
     telegram_id: str
@@ -27,9 +33,22 @@ class QRCodeCreate(BaseModel):
     user_username: Optional[str] = None
 
 
+# Схема для сохранения file_id отправленного в Telegram фото QR-кода
+class QRCodeTelegramFileId(BaseModel):
+    telegram_file_id: str
+
+
 # Схема для обновления QR-кода
 class QRCodeUpdate(BaseModel):
     status: Optional[QRCodeStatus] = None
     telegram_id: Optional[str] = None
     issued_at: Optional[datetime.datetime] = None
     used_at: Optional[datetime.datetime] = None
+
+
+# Тело запроса сканера к /check_qr
+class CheckPayload(BaseModel):
+    # Web App присылает id админа числом
+    admin_telegram_id: Optional[str] = None
+
+    model_config = ConfigDict(coerce_numbers_to_str=True)
@@ -1,3 +1,4 @@
+import asyncio
 import uvicorn
 import os
 import sys
@@ -18,14 +19,33 @@ if __name__ == "__main__":
     # Получаем порт и хост из переменных окружения или используем значения по умолчанию
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
+    # reload нужен только при разработке и несовместим с несколькими воркерами
+    debug = os.getenv("DEBUG", "").lower() in ("1", "true", "yes")
+    # Пул соединений к БД берется на каждый воркер: держите WEB_CONCURRENCY * DB_POOL_SIZE в пределах лимита БД
+    workers = 1 if debug else int(os.getenv("WEB_CONCURRENCY", "4"))
     
-    print(f"--- [DEBUG] Starting uvicorn on {host}:{port} with reload=True ---")
+    # Схему БД готовим один раз в главном процессе, а не во всех воркерах одновременно
+    from backend.app.database import engine
+    from backend.app.main import init_database
+
+    async def prepare_database():
+        await init_database()
+        # Соединения привязаны к этому event loop, воркерам они не нужны
+        await engine.dispose()
+
+    asyncio.run(prepare_database())
+    print("--- [DEBUG] Database schema is ready ---")
+
+    print(f"--- [DEBUG] Starting uvicorn on {host}:{port} with reload={debug}, workers={workers} ---")
     
     uvicorn.run(
         "backend.app.main:app",
         host=host,
         port=port,
-        reload=True
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        reload=debug
     )
     
     print("--- [DEBUG] This should not be printed if server runs correctly ---")
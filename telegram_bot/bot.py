@@ -1,12 +1,18 @@
+import asyncio
+import base64
+import hmac
 import logging
 import os
+import time
 import httpx
+import redis.asyncio as redis
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from telegram import Update, WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, ConversationHandler
-from PIL import Image
-from pyzbar.pyzbar import decode
-from io import BytesIO
+from telegram.error import BadRequest
+from telegram.ext import Application, AIORateLimiter, CommandHandler, ContextTypes, MessageHandler, filters, ConversationHandler
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -19,13 +25,90 @@ logger = logging.getLogger(__name__)
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 BACKEND_API_URL = os.getenv("BACKEND_API_URL", "http://127.0.0.1:8000")
-ADMIN_IDS = [int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "0").split(",")]
-ADMIN_LOGIN = "admin"
-ADMIN_PASSWORD = "supersecret"
-authorized_admins = set()  # user_id авторизованных админов
+ADMIN_IDS = frozenset(int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "0").split(",") if admin_id.strip())
+SCANNER_URL = "https://qr-project-elpr.onrender.com/frontend/scanner.html"
+# Кнопка сканера неизменна — собираем ее один раз, а не на каждый /scan
+SCANNER_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🚀 Открыть сканер", web_app=WebAppInfo(url=SCANNER_URL))]]
+)
+ADMIN_LOGIN = os.getenv("ADMIN_LOGIN", "admin")
+# argon2id-хэш пароля админа, например:
+# python -c "from argon2 import PasswordHasher; print(PasswordHasher().hash('пароль'))"
+ADMIN_PASSWORD_HASH = os.getenv("ADMIN_PASSWORD_HASH")
+password_hasher = PasswordHasher()
+REDIS_URL = os.getenv("REDIS_URL")
+# Публичный HTTPS-адрес самого бота. Если задан, бот получает обновления через webhook, а не long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+AUTHORIZED_ADMINS_KEY = "authorized_admins"
+# user_id авторизованных админов, если Redis не настроен (живет только до перезапуска)
+authorized_admins = set()
+# Redis хранит авторизованных админов между перезапусками и общий для всех экземпляров бота
+redis_client: redis.Redis | None = None
+# Короткий кэш перед Redis, чтобы не ходить в него на каждое сообщение активного админа
+authorized_admins_cache: TTLCache[int, bool] = TTLCache(maxsize=1_000, ttl=60)
 
 LOGIN, PASSWORD = range(2)
 
+# Общий HTTP-клиент для запросов к backend: создается при старте бота, чтобы не открывать
+# новое TCP/TLS-соединение на каждый запрос
+http_client: httpx.AsyncClient | None = None
+
+
+# У пользователя один QR-код навсегда. После первой отправки Telegram возвращает file_id фото:
+# повторный /get_qr отправляет короткую строку вместо PNG и не ходит в backend вообще.
+# file_id также хранится в backend, так что кэш переживает перезапуск бота.
+qr_file_id_cache: TTLCache[str, str] = TTLCache(maxsize=10_000, ttl=24 * 3600)
+
+QR_CAPTION = "Ваш уникальный QR-код. Предъявите его на входе."
+
+# Кэш /stats: при частых нажатиях админа в backend уходит не больше запроса в STATS_TTL секунд.
+# Старше STATS_TTL — отдаем кэш и обновляем его в фоне, старше STATS_MAX_STALE — ждем свежие данные.
+STATS_TTL = 5
+STATS_MAX_STALE = 60
+STATS_TIMEOUT = 3
+stats_cache: dict = {"ts": 0.0, "data": None, "refreshing": False}
+
+
+async def init_clients(application: Application) -> None:
+    global http_client, redis_client
+    if REDIS_URL:
+        redis_client = redis.Redis.from_url(REDIS_URL)
+    http_client = httpx.AsyncClient(
+        base_url=BACKEND_API_URL,
+        timeout=20.0,
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+
+
+async def close_clients(application: Application) -> None:
+    if http_client is not None:
+        await http_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+async def is_authorized_admin(user_id: int) -> bool:
+    """Проверяет, прошел ли пользователь /adminlogin."""
+    if user_id in authorized_admins_cache:
+        return True
+    if redis_client is None:
+        return user_id in authorized_admins
+    if await redis_client.sismember(AUTHORIZED_ADMINS_KEY, user_id):
+        authorized_admins_cache[user_id] = True
+        return True
+    return False
+
+
+async def authorize_admin(user_id: int) -> None:
+    """Запоминает пользователя как авторизованного админа."""
+    if redis_client is None:
+        authorized_admins.add(user_id)
+    else:
+        await redis_client.sadd(AUTHORIZED_ADMINS_KEY, user_id)
+    authorized_admins_cache[user_id] = True
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает команду /start. Приветствует пользователя и информирует админов."""
     user = update.effective_user
@@ -40,6 +123,36 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
 
 
+async def save_qr_file_id(qr_code_id: str, file_id: str) -> None:
+    """Сохраняет file_id фото в backend. Ошибка не критична: фото пользователь уже получил."""
+    try:
+        response = await http_client.put(
+            f"/qrcodes/{qr_code_id}/telegram_file_id",
+            json={"telegram_file_id": file_id}
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning(f"Could not save Telegram file_id for QR code {qr_code_id}: {e}")
+
+
+async def request_qr_code(user, force_image: bool = False) -> dict:
+    """
+    Один запрос к backend: создаем/получаем QR-код и сразу забираем картинку (base64 в ответе).
+    force_image просит картинку даже при сохраненном file_id.
+    """
+    payload = {
+        "telegram_id": str(user.id),
+        "user_first_name": user.first_name,
+        "user_username": user.username
+    }
+    params = {"return_image": "true"}
+    if force_image:
+        params["force_image"] = "true"
+    response = await http_client.post("/qrcodes/", params=params, json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
 async def get_qr(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает команду /get_qr. Запрашивает у бэкенда QR-код и отправляет его пользователю."""
     user = update.effective_user
@@ -47,39 +160,50 @@ async def get_qr(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"User {telegram_id} ({user.first_name}) requested a QR code.")
 
     try:
-        # 1. Отправляем запрос на backend для создания QR-кода
-        async with httpx.AsyncClient() as client:
-            payload = {
-                "telegram_id": telegram_id,
-                "user_first_name": user.first_name,
-                "user_username": user.username
-            }
-            response = await client.post(
-                f"{BACKEND_API_URL}/qrcodes/",
-                json=payload,
-                timeout=20.0
-            )
-            response.raise_for_status()
-            qr_data = response.json()
-            qr_code_id = qr_data.get("id")
-
-            if not qr_code_id:
-                raise ValueError("Backend did not return a QR code ID.")
-
-            logger.info(f"Successfully created/retrieved QR code with id {qr_code_id} for user {telegram_id}")
-
-            # 2. Скачиваем изображение QR-кода от backend
-            image_url = f"{BACKEND_API_URL}/qrcodes/{qr_code_id}/image"
-
-            async with httpx.AsyncClient() as client:
-                image_response = await client.get(image_url, timeout=20.0)
-                image_response.raise_for_status()
-                image_bytes = image_response.content
-
-            await update.message.reply_photo(
-                photo=image_bytes,
-                caption="Ваш уникальный QR-код. Предъявите его на входе."
-            )
+        # file_id действует только для бота, который его получил: после смены токена Telegram
+        # отвечает BadRequest, и фото загружается заново из байтов
+        force_image = False
+        cached_file_id = qr_file_id_cache.get(telegram_id)
+        if cached_file_id is not None:
+            try:
+                await update.message.reply_photo(photo=cached_file_id, caption=QR_CAPTION)
+                return
+            except BadRequest as e:
+                logger.warning(f"Cached file_id for user {telegram_id} was rejected: {e}")
+                qr_file_id_cache.pop(telegram_id, None)
+                force_image = True
+
+        qr_data = await request_qr_code(user, force_image=force_image)
+        qr_code_id = qr_data.get("id")
+        file_id = qr_data.get("telegram_file_id")
+
+        if not qr_code_id or not (file_id or qr_data.get("image_b64")):
+            raise ValueError("Backend did not return a QR code ID or image.")
+
+        logger.info(f"Successfully created/retrieved QR code with id {qr_code_id} for user {telegram_id}")
+
+        if file_id and not force_image:
+            # Фото уже загружалось в Telegram — отправляем по file_id
+            try:
+                await update.message.reply_photo(photo=file_id, caption=QR_CAPTION)
+                qr_file_id_cache[telegram_id] = file_id
+                return
+            except BadRequest as e:
+                logger.warning(f"Stored file_id for QR code {qr_code_id} was rejected: {e}")
+                qr_data = await request_qr_code(user, force_image=True)
+
+        image_b64 = qr_data.get("image_b64")
+        if not image_b64:
+            raise ValueError("Backend did not return a QR code image.")
+
+        message = await update.message.reply_photo(
+            photo=base64.b64decode(image_b64),
+            caption=QR_CAPTION
+        )
+        # Новый file_id перезаписывает в backend устаревший
+        file_id = message.photo[-1].file_id
+        await save_qr_file_id(qr_code_id, file_id)
+        qr_file_id_cache[telegram_id] = file_id
     except httpx.RequestError as e:
         logger.error(f"Could not connect to backend: {e}")
         await update.message.reply_text(
@@ -92,6 +216,18 @@ async def get_qr(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
 
 
+def check_admin_credentials(login: str | None, password: str) -> bool:
+    """Проверяет логин и пароль админа без утечки времени сравнения."""
+    login_ok = hmac.compare_digest((login or "").encode(), ADMIN_LOGIN.encode())
+    if not ADMIN_PASSWORD_HASH:
+        return False
+    try:
+        password_ok = password_hasher.verify(ADMIN_PASSWORD_HASH, password)
+    except (VerificationError, InvalidHashError):
+        password_ok = False
+    return login_ok and password_ok
+
+
 async def adminlogin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Введите логин администратора:")
     return LOGIN
@@ -106,8 +242,9 @@ async def adminlogin_password(update: Update, context: ContextTypes.DEFAULT_TYPE
     password = update.message.text
     user_id = update.effective_user.id
 
-    if login == ADMIN_LOGIN and password == ADMIN_PASSWORD:
-        authorized_admins.add(user_id)
+    # argon2 намеренно медленный — проверяем в отдельном потоке, чтобы не блокировать остальные апдейты
+    if await asyncio.to_thread(check_admin_credentials, login, password):
+        await authorize_admin(user_id)
         await update.message.reply_text("✅ Вы авторизованы как администратор!")
         return ConversationHandler.END
     else:
@@ -130,32 +267,53 @@ adminlogin_conv = ConversationHandler(
 async def scan_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """(Только для админов) Отправляет кнопку для запуска Web App сканера."""
     user_id = update.effective_user.id
-    if user_id not in authorized_admins:
+    if not await is_authorized_admin(user_id):
         await update.message.reply_text("Доступ запрещён. Авторизуйтесь через /adminlogin.")
         return
-    scanner_url = "https://qr-project-elpr.onrender.com/frontend/scanner.html"
-    keyboard = [[InlineKeyboardButton("🚀 Открыть сканер", web_app=WebAppInfo(url=scanner_url))]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         "Нажмите кнопку ниже, чтобы открыть камеру и начать сканирование.",
-        reply_markup=reply_markup
+        reply_markup=SCANNER_MARKUP
     )
 
 
+async def fetch_stats() -> dict:
+    """Запрашивает общую статистику у backend и обновляет кэш."""
+    response = await http_client.get("/stats", timeout=STATS_TIMEOUT)
+    response.raise_for_status()
+    stats_cache["data"] = response.json()
+    stats_cache["ts"] = time.monotonic()
+    return stats_cache["data"]
+
+
+async def refresh_stats() -> None:
+    """Фоновое обновление устаревшего кэша статистики."""
+    try:
+        await fetch_stats()
+    except httpx.HTTPError as e:
+        logger.warning(f"Could not refresh stats: {e}")
+    finally:
+        stats_cache["refreshing"] = False
+
+
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    if user_id not in authorized_admins:
+    if not await is_authorized_admin(user_id):
         await update.message.reply_text("Доступ запрещён. Авторизуйтесь через /adminlogin.")
         return
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{BACKEND_API_URL}/stats", timeout=10)
-            data = response.json()
-            await update.message.reply_text(
-                f"📊 Общая статистика:\n"
-                f"✅ Всего успешно: {data.get('success', 0)}\n"
-                f"⛔ Всего отклонено: {data.get('fail', 0)}"
-            )
+        data = stats_cache["data"]
+        age = time.monotonic() - stats_cache["ts"]
+        if data is None or age >= STATS_MAX_STALE:
+            data = await fetch_stats()
+        elif age >= STATS_TTL and not stats_cache["refreshing"]:
+            # Отвечаем слегка устаревшими цифрами сразу, а кэш обновляем в фоне
+            stats_cache["refreshing"] = True
+            context.application.create_task(refresh_stats())
+        await update.message.reply_text(
+            f"📊 Общая статистика:\n"
+            f"✅ Всего успешно: {data.get('success', 0)}\n"
+            f"⛔ Всего отклонено: {data.get('fail', 0)}"
+        )
     except Exception as e:
         await update.message.reply_text("Ошибка при получении статистики.")
 
@@ -170,8 +328,20 @@ def main() -> None:
     if not TELEGRAM_BOT_TOKEN:
         logger.error("Токен бота не найден в .env файле! Завершение работы.")
         return
-
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    if not ADMIN_PASSWORD_HASH:
+        logger.warning("ADMIN_PASSWORD_HASH не задан — вход администратора через /adminlogin невозможен.")
+
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # Сглаживаем исходящие запросы под лимиты Telegram (~30 сообщений/с), чтобы не ловить 429
+        .rate_limiter(
+            AIORateLimiter(overall_max_rate=30, overall_time_period=1, group_max_rate=20, group_time_period=60)
+        )
+        .post_init(init_clients)
+        .post_shutdown(close_clients)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("get_qr", get_qr))
@@ -180,8 +350,19 @@ def main() -> None:
     application.add_handler(adminlogin_conv)
     application.add_error_handler(error_handler)
 
-    logger.info("Starting bot...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        # Telegram сам присылает обновления — без постоянных запросов getUpdates
+        logger.info("Starting bot in webhook mode...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8443")),
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+        )
+    else:
+        logger.info("Starting bot...")
+        application.run_polling()
 
 
 if __name__ == "__main__":